@@ -3,6 +3,8 @@ CONFIG = {
     'INPUT_FILENAME': 'export_03_15Feb.csv',
     'OUTPUT_FILENAME': 'data_prepped_for_nb.csv',
     'SAMPLE_OUTPUT_FILENAME': 'sample_output.csv',
+    'DELETED_TEST_ROWS_FILENAME': 'deleted_test_rows.csv',
+    'RELIGIONS_FOR_CLEANING_FILENAME': 'relgions_for_cleaning.csv',
     'EXPECTED_ROW_COUNT': 68589,
     'EXPECTED_COL_COUNT': 297,
     'DATA_DIRECTORY': 'data',
@@ -15,6 +17,25 @@ CONFIG = {
         'https://spreadsheets.google.com/feeds',
         'https://www.googleapis.com/auth/drive'],
     'META_DATA_TMP_FILENAME': 'meta_data.csv',
+    'DEFAULT_TARGETS': [
+        'output',
+        'sample',
+        'multiChoiceLists',
+        'deletedTestRows'],
+    'MAX_BACKGROUND_THREADS': 4,
+    'DEFAULT_ENGINE': 'pandas',
+    # The strings pandas 0.23 (see requirements.txt) reads as null by
+    # default, so the arrow engine can do the same
+    'ARROW_NULL_VALUES': [
+        '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+        '-nan', '1.#IND', '1.#QNAN', 'N/A', 'NA', 'NULL', 'NaN', 'n/a',
+        'nan', 'null'],
+    'DATE_COLS': ['Join Date'],
+    # Dates must match SOURCE_DATE_PATTERN as a whole, then the part before
+    # any time is parsed with SOURCE_DATE_FORMAT
+    'SOURCE_DATE_PATTERN': r'^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}(:\d{2})?)?$',
+    'SOURCE_DATE_FORMAT': '%Y-%m-%d',
+    'TARGET_DATE_FORMAT': '%m/%d/%Y',
     'COLS_WITH_REPEATD_DATA': [
         'Organisational/company sign up:Region',
         'Schools 2018:Key Contact Name',
@@ -8,6 +8,10 @@ import shutil
 import json
 import gspread
 import csv
+import time
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from oauth2client.service_account import ServiceAccountCredentials
 
 from config import CONFIG
@@ -24,17 +28,43 @@ def processArgs(args):
         '--meta',
         help='Get the latest metadata from the Source To Target Mapping doc',
         action='store_true')
-    args = parser.parse_args()
+    parser.add_argument(
+        '--targets',
+        help='The outputs to build. Stages that are not needed to build ' +
+             'these targets are skipped. Defaults to: ' +
+             ', '.join(CONFIG['DEFAULT_TARGETS']),
+        nargs='+',
+        choices=TARGETS,
+        metavar='TARGET')
+    parser.add_argument(
+        '--engine',
+        help='The CSV parsing engine used to load the input file. arrow ' +
+             'uses a multi-threaded reader and needs pyarrow installed',
+        choices=ENGINES,
+        default=CONFIG['DEFAULT_ENGINE'])
+    parser.add_argument(
+        '--compare-engines',
+        help="Load the input file with every engine, time them and check " +
+             "they produce the same data - doesn't run the pipeline",
+        action='store_true')
+    args = parser.parse_args(args)
 
     # Set default options, then edit based on command line args
     options = {
         'LOAD_METADATA_FROM_GSHEET': False,
-        'ONLY_RUN_SETUP': False}
+        'ONLY_RUN_SETUP': False,
+        'ONLY_COMPARE_ENGINES': False,
+        'TARGETS': CONFIG['DEFAULT_TARGETS'],
+        'ENGINE': args.engine}
 
     if args.meta:
         options['LOAD_METADATA_FROM_GSHEET'] = True
     if args.setup:
         options['ONLY_RUN_SETUP'] = True
+    if args.targets:
+        options['TARGETS'] = args.targets
+    if args.compare_engines:
+        options['ONLY_COMPARE_ENGINES'] = True
 
     return options
 
@@ -180,32 +210,164 @@ def loadMetaDataFromTempFile():
     return (meta, rels, repData)
 
 
-def loadData(meta):
+# The engines loadData can use to parse the input file
+ENGINES = ['pandas', 'arrow']
 
-    funcName = 'Loading Data from CSV'
-    logFunctionStart(funcName)
-    report = ''
+
+def getInputFilePath():
+
+    path = CONFIG['DATA_DIRECTORY'] + '/' + CONFIG['INPUT_FILENAME']
 
     # Check source data is there
-    if not os.path.isfile(CONFIG['DATA_DIRECTORY'] + '/' +
-                          CONFIG['INPUT_FILENAME']):
+    if not os.path.isfile(path):
         raise ValueError('Failed to find the input data file. I expected to ' +
                          'find it in the same directory as the code, ' +
-                         'named: ' + CONFIG['DATA_DIRECTORY'] + '/' +
-                         CONFIG['INPUT_FILENAME'] + '. Either ' +
+                         'named: ' + path + '. Either ' +
                          'add the file to the directory, or change the ' +
                          'expected file name in config.py')
 
-    df = pd.read_csv(
-        CONFIG['DATA_DIRECTORY'] + '/' + CONFIG['INPUT_FILENAME'],
+    return path
+
+
+def readCsvWithPandas(path):
+
+    return pd.read_csv(
+        path,
         low_memory=False,
         dtype={'Work Phone': 'object'})
 
+
+def readCsvWithArrow(path):
+
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pacsv
+    except ImportError:
+        raise ValueError('The arrow engine needs pyarrow. Either install ' +
+                         'it with `$ pip install pyarrow`, or use ' +
+                         '`--engine pandas`')
+
+    # Work Phone is read as a string, as with the pandas engine. Like
+    # pandas' dtype override, this matches the raw header name.
+    columnTypes = {'Work Phone': pa.string()}
+
+    def readTable():
+        with pa.memory_map(path, 'r') as source:
+            return pacsv.read_csv(
+                source,
+                read_options=pacsv.ReadOptions(use_threads=True),
+                parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                convert_options=pacsv.ConvertOptions(
+                    column_types=columnTypes,
+                    null_values=CONFIG['ARROW_NULL_VALUES'],
+                    strings_can_be_null=True,
+                    true_values=['True', 'TRUE', 'true'],
+                    false_values=['False', 'FALSE', 'false']))
+
+    table = readTable()
+
+    # Arrow recognises dates and times, which pandas leaves as strings. If
+    # it found any, read the file again with those columns as strings
+    unexpectedTemporalCols = [field.name for field in table.schema
+                              if pa.types.is_temporal(field.type)]
+    if len(unexpectedTemporalCols) > 0:
+        for colName in unexpectedTemporalCols:
+            columnTypes[colName] = pa.string()
+        table = readTable()
+
+    emptyCols = [field.name for field in table.schema
+                 if pa.types.is_null(field.type)]
+
+    df = table.to_pandas()
+
+    # Arrow gives us None for null strings (and bools), and an object column
+    # of Nones for completely empty columns, where pandas would give NaN and
+    # a float column respectively
+    for col in df.columns[df.dtypes == object]:
+        if col in emptyCols:
+            df[col] = df[col].astype('float64')
+        else:
+            df[col] = df[col].where(df[col].notnull(), np.nan)
+
+    # pandas de-duplicates repeated column names by appending .1, .2 etc
+    seenCols = {}
+    dedupedCols = []
+    for col in df.columns:
+        if col in seenCols:
+            seenCols[col] += 1
+            dedupedCols.append(col + '.' + str(seenCols[col]))
+        else:
+            seenCols[col] = 0
+            dedupedCols.append(col)
+    df.columns = dedupedCols
+
+    return df
+
+
+def readInputFile(engine):
+
+    path = getInputFilePath()
+
+    if engine == 'arrow':
+        df = readCsvWithArrow(path)
+    else:
+        df = readCsvWithPandas(path)
+
     # Some of the column names have carriage returns in, which
     # is a problem for matching to our list of in-scope columns.
     allCols = df.columns.str.replace('\n', '')
     df.columns = allCols
 
+    return df
+
+
+def compareEngines():
+
+    funcName = 'Comparing CSV Parsing Engines'
+    logFunctionStart(funcName)
+    report = ''
+
+    dfs = {}
+    for engine in ENGINES:
+        startTime = time.time()
+        dfs[engine] = readInputFile(engine)
+        report += ('Loaded ' + str(dfs[engine].shape[0]) + ' rows and ' +
+                   str(dfs[engine].shape[1]) + ' columns with the ' + engine +
+                   ' engine in ' + str(round(time.time() - startTime, 2)) +
+                   ' seconds\n')
+
+    expected = dfs[ENGINES[0]]
+    for engine in ENGINES[1:]:
+        df = dfs[engine]
+        if list(df.columns) != list(expected.columns):
+            report += ('ERROR: the ' + engine + ' engine produced different ' +
+                       'columns to the ' + ENGINES[0] + ' engine\n')
+            continue
+        for col in expected.columns[expected.dtypes != df.dtypes]:
+            report += ('ERROR: ' + col + ' is ' + str(df[col].dtype) +
+                       ' with the ' + engine + ' engine but ' +
+                       str(expected[col].dtype) + ' with the ' +
+                       ENGINES[0] + ' engine\n')
+        # Compare the data as it would be written out, so we know
+        # the pipeline output will be byte-identical
+        if df.to_csv(index=False) == expected.to_csv(index=False):
+            report += ('The ' + engine + ' engine produced identical data ' +
+                       'to the ' + ENGINES[0] + ' engine\n')
+        else:
+            report += ('ERROR: the ' + engine + ' engine produced different ' +
+                       'data to the ' + ENGINES[0] + ' engine\n')
+
+    logFunctionEnd(report)
+
+
+def loadData(meta, engine='pandas'):
+
+    funcName = 'Loading Data from CSV'
+    logFunctionStart(funcName)
+    report = ''
+
+    df = readInputFile(engine)
+
     # For testing
     # df = df.loc[df['Email'].isin([''])]
     # df.to_csv('temp_temp.csv')
@@ -287,14 +449,25 @@ def deleteTestData(df):
     df_merged = pd.merge(df, df_testRows, indicator=True, how='outer')
     df = df_merged.query('_merge=="left_only"').drop('_merge', axis=1)
 
-    report += ('Deleted ' + str(df_testRows.shape[0]) + ' rows. See ' +
-               'deleted_test_rows.csv')
-
-    df_testRows.to_csv(CONFIG['DATA_DIRECTORY'] + '/' + 'deleted_test_rows.csv', index=False)
+    report += 'Deleted ' + str(df_testRows.shape[0]) + ' rows'
 
     logFunctionEnd(report)
 
-    return df
+    return (df, df_testRows)
+
+
+def outputDeletedTestRows(df_testRows):
+
+    funcName = 'Saving Deleted Test Rows as CSV'
+    logFunctionStart(funcName)
+    report = ''
+
+    df_testRows.to_csv(CONFIG['DATA_DIRECTORY'] + '/' +
+                       CONFIG['DELETED_TEST_ROWS_FILENAME'], index=False)
+    report += ('Saved ' + str(df_testRows.shape[0]) + ' deleted rows to ' +
+               CONFIG['DELETED_TEST_ROWS_FILENAME'])
+
+    logFunctionEnd(report)
 
 
 def outputColumnsWithRepeatedData(df):
@@ -308,7 +481,7 @@ def outputColumnsWithRepeatedData(df):
             CONFIG['GOOGLE_API_SCOPE']))
     ss = _client.open(CONFIG['REPEATED_DATA_GSHEET_NAME'])
 
-    cols = CONFIG['COLS_WITH_REPEATED_DATE']
+    cols = CONFIG['COLS_WITH_REPEATD_DATA']
 
     existingWSs = ss.worksheets()
     existingWSTitles = []
@@ -356,12 +529,65 @@ def outputReligionData(df):
 
     rels = pd.DataFrame(df['Are you a person of faith?'].unique()).dropna()
     rels.columns = ['VALUES']
-    rels.to_csv('data/relgions_for_cleaning.csv', index=False)
+    rels.to_csv(CONFIG['DATA_DIRECTORY'] + '/' +
+                CONFIG['RELIGIONS_FOR_CLEANING_FILENAME'], index=False)
 
     logFunctionEnd()
 
 
-def cleanData(df, rels, repData):
+def getDateColumns(meta):
+
+    # Dates are either standard NationBuilder fields (listed in config.py)
+    # or custom fields with a type of Date in the STM
+    dateCols = list(CONFIG['DATE_COLS'])
+    dateCols += list(meta.loc[meta['Custom Field Type?'] == 'Date',
+                              'fullColName'])
+
+    # A column could be in both lists, and converting a date twice would
+    # blank it (it no longer matches the source format)
+    return list(dict.fromkeys(dateCols))
+
+
+def normaliseDates(values):
+
+    # Convert a column of dates from the legacy system's format to
+    # NationBuilder's. Lots of rows share the same date, so we only parse
+    # each distinct value once and then map the conversions back onto the
+    # column. Blanks stay blank. Values that don't match the format are
+    # replaced with empty string and returned, so the caller can report them
+
+    uniqueValues = pd.Series(values.unique())
+    uniqueValues = uniqueValues[uniqueValues != '']
+
+    # Check each whole value against the expected pattern (a date with an
+    # optional time) before parsing, so nothing else slips through as a
+    # partial match. The date part of the values that match is then parsed
+    # with the explicit format, which also rejects impossible dates like
+    # 2016-13-45. The time is dropped.
+    stringValues = uniqueValues.astype(str)
+    isWellFormed = stringValues.str.match(CONFIG['SOURCE_DATE_PATTERN'])
+    datePart = stringValues[isWellFormed].str.split(' ', n=1).str[0]
+    parsedValues = pd.to_datetime(datePart,
+                                  format=CONFIG['SOURCE_DATE_FORMAT'],
+                                  exact=True,
+                                  errors='coerce')
+    parsedValues = parsedValues[parsedValues.notna()]
+    isValid = uniqueValues.index.isin(parsedValues.index)
+
+    conversions = dict(zip(
+        uniqueValues[isValid],
+        parsedValues.dt.strftime(CONFIG['TARGET_DATE_FORMAT'])))
+    unparseableValues = list(uniqueValues[~isValid])
+    for val in unparseableValues:
+        conversions[val] = ''
+    conversions[''] = ''
+
+    unparseableRowCount = int(values.isin(unparseableValues).sum())
+
+    return (values.map(conversions), unparseableRowCount, unparseableValues)
+
+
+def cleanData(df, meta, rels, repData):
 
     funcName = 'Cleaning Data'
     logFunctionStart(funcName)
@@ -409,18 +635,16 @@ def cleanData(df, rels, repData):
     df.loc[df['Work Phone'] == '02072193000', 'Work Phone'] = ''
 
     report += 'Changed date format to be compatible with NationBuilder\n'
-    df['Join Date - year'] = df['Join Date'].str.slice(0, 4)
-    df['Join Date - month'] = df['Join Date'].str.slice(5, 7)
-    df['Join Date - day'] = df['Join Date'].str.slice(8, 10)
-
-    df['Join Date'] = df['Join Date - month'].astype(str) + '/' + \
-        df['Join Date - day'].astype(str) + '/' + \
-        df['Join Date - year'].astype(str)
-
-    df.drop(
-        ['Join Date - year', 'Join Date - month', 'Join Date - day'],
-        axis=1,
-        inplace=True)
+    for col in [col for col in getDateColumns(meta) if col in df.columns]:
+        (df[col], unparseableRowCount, unparseableValues) = \
+            normaliseDates(df[col])
+        if unparseableRowCount > 0:
+            report += (' - WARNING: ' + str(unparseableRowCount) + ' rows ' +
+                       'of ' + col + ' did not match the date format ' +
+                       CONFIG['SOURCE_DATE_FORMAT'] + ', so were replaced ' +
+                       'with empty string. E.g. ' +
+                       ', '.join(['"' + str(val) + '"' for val in
+                                  unparseableValues[0:5]]) + '\n')
 
     report += 'Cleaned religion columns based on manual mapping\n'
     new_df = pd.merge(
@@ -450,7 +674,7 @@ def cleanData(df, rels, repData):
     report += 'Replaced any null values with empty string (again!)\n'
     df = df.fillna('')
 
-    logFunctionEnd()
+    logFunctionEnd(report)
 
     return df
 
@@ -478,6 +702,11 @@ def processTags(df, meta):
     funcName = 'Processing Tags'
     logFunctionStart(funcName)
 
+    # The cleaned data is also read by the multiple-choice list output, which
+    # runs in the background, so work on our own copy rather than adding the
+    # tags column to the shared frame
+    df = df.copy()
+
     df_tagMapping = meta.loc[(meta['Tag?'] == 'T') & (meta['IN SCOPE'] == 'T'),
                              ['fullColName', 'Tag Name']]
     tagMapping = df_tagMapping.set_index('fullColName')['Tag Name'].to_dict()
@@ -633,55 +862,313 @@ def outputData(df):
     logFunctionStart(funcName)
     report = ''
 
-    sampleSize = 10000
-
     df.to_csv(CONFIG['DATA_DIRECTORY'] + '/' +
               CONFIG['OUTPUT_FILENAME'], index=False)
-    df.head(sampleSize).to_csv(CONFIG['DATA_DIRECTORY'] + '/' +
-                               CONFIG['SAMPLE_OUTPUT_FILENAME'], index=False)
     report += ("Saved " + str(df.shape[0]) + " rows of data to " +
                CONFIG['OUTPUT_FILENAME'] + '\n')
-    report += ("Also saved " + str(sampleSize) + " rows of data to " +
-               CONFIG['SAMPLE_OUTPUT_FILENAME'] + '\n')
 
     logFunctionEnd(report)
 
 
-def run(args):
+def outputSample(df):
+    funcName = 'outputSample'
+    logFunctionStart(funcName)
+    report = ''
 
-    opts = processArgs(args)
+    sampleSize = 10000
 
-    setup()
+    df.head(sampleSize).to_csv(CONFIG['DATA_DIRECTORY'] + '/' +
+                               CONFIG['SAMPLE_OUTPUT_FILENAME'], index=False)
+    report += ("Saved " + str(min(sampleSize, df.shape[0])) +
+               " rows of data to " + CONFIG['SAMPLE_OUTPUT_FILENAME'] + '\n')
 
-    if opts['ONLY_RUN_SETUP']:
-        sys.exit()
+    logFunctionEnd(report)
+
+
+def loadMetadata(opts):
 
     if opts['LOAD_METADATA_FROM_GSHEET']:
-        (meta, rels, repData) = loadMetadataFromGSheet()
+        return loadMetadataFromGSheet()
     else:
-        (meta, rels, repData) = loadMetaDataFromTempFile()
+        return loadMetaDataFromTempFile()
+
+
+def getStages(opts):
+
+    # The pipeline is declared as a DAG of stages. Each stage names the
+    # artifacts it needs (passed to func positionally, in order) and the
+    # artifacts it produces (returned by func - a tuple if there's more than
+    # one). Stages that only write files produce a target and return None.
+    # Side outputs that don't change the frame are flagged as background, so
+    # they run in a thread while the main transform carries on. A stage must
+    # not modify an input frame that a background stage also reads, because
+    # the background stage may still be reading it.
+    #
+    # Stages must be listed in an order where every input is produced by an
+    # earlier stage.
+    return [
+        {'name': 'loadMetadata',
+         'func': lambda: loadMetadata(opts),
+         'inputs': [],
+         'outputs': ['meta', 'rels', 'repData']},
+        {'name': 'loadData',
+         'func': lambda meta: loadData(meta, opts['ENGINE']),
+         'inputs': ['meta'],
+         'outputs': ['rawData']},
+        {'name': 'filterToInscopeColumns',
+         'func': filterToInscopeColumns,
+         'inputs': ['rawData', 'meta'],
+         'outputs': ['inScopeData']},
+        {'name': 'deleteTestData',
+         'func': deleteTestData,
+         'inputs': ['inScopeData'],
+         'outputs': ['testFreeData', 'testRows']},
+        {'name': 'outputDeletedTestRows',
+         'func': outputDeletedTestRows,
+         'inputs': ['testRows'],
+         'outputs': ['deletedTestRows'],
+         'background': True},
+        # This will overwrite the repeated-values spreadsheet, which you
+        # probably don't want to do, given that JCF have already manually
+        # cleaned the data in this spreadsheet! Hence it's not a default target
+        {'name': 'outputColumnsWithRepeatedData',
+         'func': outputColumnsWithRepeatedData,
+         'inputs': ['testFreeData'],
+         'outputs': ['repeatedDataGSheet'],
+         'background': True},
+        {'name': 'outputReligionData',
+         'func': outputReligionData,
+         'inputs': ['testFreeData'],
+         'outputs': ['religionData'],
+         'background': True},
+        {'name': 'cleanData',
+         'func': cleanData,
+         'inputs': ['testFreeData', 'meta', 'rels', 'repData'],
+         'outputs': ['cleanData']},
+        {'name': 'outputMultiChoiceLists',
+         'func': outputMultiChoiceLists,
+         'inputs': ['cleanData', 'meta'],
+         'outputs': ['multiChoiceLists'],
+         'background': True},
+        {'name': 'processTags',
+         'func': processTags,
+         'inputs': ['cleanData', 'meta'],
+         'outputs': ['taggedData']},
+        {'name': 'mapColumns',
+         'func': mapColumns,
+         'inputs': ['taggedData', 'meta'],
+         'outputs': ['mappedData']},
+        {'name': 'outputData',
+         'func': outputData,
+         'inputs': ['mappedData'],
+         'outputs': ['output']},
+        {'name': 'outputSample',
+         'func': outputSample,
+         'inputs': ['mappedData'],
+         'outputs': ['sample'],
+         'background': True}]
+
+
+# The artifacts that can be requested on the command line with --targets.
+# These are the stages' file outputs - the intermediate frames can't be built
+# on their own.
+TARGETS = [
+    'output',
+    'sample',
+    'multiChoiceLists',
+    'deletedTestRows',
+    'religionData',
+    'repeatedDataGSheet']
+
+
+def selectStages(stages, targets):
+
+    # Walk back from the requested targets to find every stage we need to
+    # run. Anything not found along the way is skipped.
+
+    producers = {}
+    for stage in stages:
+        for output in stage['outputs']:
+            producers[output] = stage
+
+    required = set()
+    toVisit = list(targets)
+    while len(toVisit) > 0:
+        artifact = toVisit.pop()
+        if artifact not in producers:
+            raise ValueError('No stage produces ' + artifact)
+        stage = producers[artifact]
+        if stage['name'] not in required:
+            required.add(stage['name'])
+            toVisit.extend(stage['inputs'])
+
+    return [stage for stage in stages if stage['name'] in required]
+
+
+class ThreadBufferedOutput:
+
+    # Stands in for sys.stdout while the stages run. Threads that have
+    # called startBuffering() write to their own buffer, everything else
+    # goes straight to the real stdout
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def startBuffering(self):
+        self.local.buffer = io.StringIO()
+
+    def stopBuffering(self):
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return output
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stdout.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+def runStages(stages, targets):
+
+    funcName = 'Running Pipeline Stages'
+    logFunctionStart(funcName)
+    report = ''
 
-    df = loadData(meta)
+    stagesToRun = selectStages(stages, targets)
+    skippedStages = [stage['name'] for stage in stages
+                     if stage not in stagesToRun]
 
-    df = filterToInscopeColumns(df, meta)
+    report += 'Building targets: ' + ', '.join(targets) + '\n'
+    report += 'Running stages: ' + \
+        ', '.join([stage['name'] for stage in stagesToRun]) + '\n'
+    if len(skippedStages) > 0:
+        report += 'Skipping stages: ' + ', '.join(skippedStages) + '\n'
 
-    df = deleteTestData(df)
+    logFunctionEnd(report)
 
-    # If you uncomment this, it will overwrite the repeated-values spreadsheet,
-    # which you probably don't want to do, given that JCF have already manually
-    # cleaned the data in this spreadsheet!
-    # outputColumnsWithRepeatedData(df)
-    # outputReligionData(df)
+    # Artifacts produced so far, and the futures of background stages that
+    # haven't necessarily finished yet (keyed by each of their outputs)
+    artifacts = {}
+    pending = {}
+    futures = []
+    collectedFutures = set()
+
+    # How many stages still need each artifact. Once nothing else needs an
+    # intermediate frame we drop it, so we only hold onto the frames that
+    # are still in use (background stages keep their own references to
+    # their inputs until they finish)
+    usesLeft = {}
+    for stage in stagesToRun:
+        for name in stage['inputs']:
+            usesLeft[name] = usesLeft.get(name, 0) + 1
+
+    # Background stages log as they go, like every other stage. So their
+    # output doesn't land in the middle of the main path's output, it's
+    # buffered and printed in one piece once the stage has finished
+    stageOutput = ThreadBufferedOutput(sys.stdout)
+
+    def runStage(stage, inputs):
+        result = stage['func'](*inputs)
+        if len(stage['outputs']) == 1:
+            result = (result,)
+        for output, value in zip(stage['outputs'], result):
+            artifacts[output] = value
+
+    def runBackgroundStage(stage, inputs):
+        stageOutput.startBuffering()
+        error = None
+        try:
+            runStage(stage, inputs)
+        except Exception as e:
+            error = e
+        return (stageOutput.stopBuffering(), error)
+
+    def collect(future):
+        # Print a finished background stage's output and re-raise any
+        # error it hit. Blocks if the stage hasn't finished yet.
+        if future in collectedFutures:
+            return
+        collectedFutures.add(future)
+        (log, error) = future.result()
+        print(log, end='')
+        if error is not None:
+            raise error
+
+    def getArtifact(name):
+        if name not in artifacts:
+            if name not in pending:
+                raise ValueError('Stage input ' + name + ' has not been ' +
+                                 'produced by an earlier stage')
+            # A background stage's result is needed by a later stage,
+            # so wait for it
+            collect(pending[name])
+        return artifacts[name]
+
+    executor = ThreadPoolExecutor(
+        max_workers=CONFIG['MAX_BACKGROUND_THREADS'])
+    sys.stdout = stageOutput
+    try:
+        for stage in stagesToRun:
+
+            # Between main stages, pick up any background stages that have
+            # finished, so we fail fast rather than after the whole main path
+            for future in futures:
+                if future.done():
+                    collect(future)
+
+            inputs = [getArtifact(name) for name in stage['inputs']]
+            if stage.get('background', False):
+                future = executor.submit(runBackgroundStage, stage, inputs)
+                futures.append(future)
+                for output in stage['outputs']:
+                    pending[output] = future
+            else:
+                runStage(stage, inputs)
+            inputs = None
+
+            for name in stage['inputs']:
+                usesLeft[name] -= 1
+            for name in list(artifacts):
+                if usesLeft.get(name, 0) == 0 and name not in targets:
+                    artifacts.pop(name, None)
+
+        # Wait for the remaining background stages, in the order they finish
+        for future in as_completed(futures):
+            collect(future)
+    finally:
+        # If something failed, don't start any background stages that are
+        # still queued, and print the output of any that were already
+        # running (their errors are secondary to the one we're raising)
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        sys.stdout = stageOutput.stdout
+        for future in futures:
+            if future not in collectedFutures and not future.cancelled():
+                print(future.result()[0], end='')
+
+    return {target: artifacts[target] for target in targets}
 
-    df = cleanData(df, rels, repData)
 
-    outputMultiChoiceLists(df, meta)
+def run(args):
 
-    df = processTags(df, meta)
+    opts = processArgs(args)
 
-    df = mapColumns(df, meta)
+    setup()
+
+    if opts['ONLY_RUN_SETUP']:
+        sys.exit()
+
+    if opts['ONLY_COMPARE_ENGINES']:
+        compareEngines()
+        sys.exit()
 
-    outputData(df)
+    runStages(getStages(opts), opts['TARGETS'])
 
 
 if __name__ == "__main__":